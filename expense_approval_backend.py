@@ -1,18 +1,57 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlmodel import SQLModel, Session, create_engine, Field, Relationship, select
-from typing import Optional, List
-from datetime import datetime
-import uuid
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.decorator import cache
+from sqlmodel import SQLModel, Field, Relationship, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import Column, DateTime, Enum as SAEnum, event, func, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import raiseload
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from typing import Optional, List, Dict, Iterable, Tuple
+from datetime import datetime, timedelta, timezone
+from enum import Enum
+from types import MappingProxyType
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from jose import jwt, JWTError
+from passlib.hash import bcrypt
+import anyio
+import hashlib
+import hmac
+import os
+import secrets
+import warnings
 
 # -----------------------
 # Database setup
 # -----------------------
-engine = create_engine("sqlite:///database.db")
-
-
-def get_session():
-    with Session(engine) as session:
+engine = create_async_engine(
+    "sqlite+aiosqlite:///database.db",
+    poolclass=AsyncAdaptedQueuePool,  # aiosqlite defaults to NullPool for file databases
+    pool_size=20,
+    max_overflow=40,
+    pool_recycle=3600,
+)
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the single writer; NORMAL sync is safe under WAL
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+async def get_session():
+    # no expire on commit: reloading expired attributes would need implicit async IO
+    async with AsyncSession(engine, expire_on_commit=False) as session:
         yield session
 
 
@@ -28,7 +67,7 @@ class Company(SQLModel, table=True):
     users: List["User"] = Relationship(back_populates="company")
 
 
-class UserRole(str):
+class UserRole(str, Enum):
     ADMIN = "admin"
     MANAGER = "manager"
     EMPLOYEE = "employee"
@@ -36,16 +75,21 @@ class UserRole(str):
 
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    email: str
-    password: str  # demo only, use hashing in production!
-    role: str
-    company_id: int = Field(foreign_key="company.id")
+    email: str = Field(index=True, unique=True)
+    password: str  # bcrypt hash
+    role: UserRole = Field(sa_column=Column(
+        # store the values ("admin", ...) rather than member names, guarded by a CHECK constraint
+        SAEnum(UserRole, values_callable=lambda roles: [r.value for r in roles],
+               native_enum=False, create_constraint=True, length=16),
+        nullable=False,
+    ))
+    company_id: int = Field(foreign_key="company.id", index=True)
 
     company: Optional[Company] = Relationship(back_populates="users")
     expenses: List["Expense"] = Relationship(back_populates="user")
     approvals: List["ApprovalRequest"] = Relationship(back_populates="approver")
 
-    manager_id: Optional[int] = Field(default=None, foreign_key="user.id")
+    manager_id: Optional[int] = Field(default=None, foreign_key="user.id", index=True)
     manager: Optional["User"] = Relationship(sa_relationship_kwargs={"remote_side": "User.id"})
 
 
@@ -55,8 +99,10 @@ class Expense(SQLModel, table=True):
     currency: str
     category: str
     description: str
-    date: datetime
-    user_id: int = Field(foreign_key="user.id")
+    # default renders CURRENT_TIMESTAMP into the INSERT, so databases created before server_default still work
+    date: datetime = Field(sa_column=Column(DateTime, default=func.now(), server_default=func.now(),
+                                            nullable=False))
+    user_id: int = Field(foreign_key="user.id", index=True)
 
     user: Optional[User] = Relationship(back_populates="expenses")
     approvals: List["ApprovalRequest"] = Relationship(back_populates="expense")
@@ -66,8 +112,8 @@ class ApprovalRequest(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     status: str = "pending"  # pending/approved/rejected
     step: int
-    expense_id: int = Field(foreign_key="expense.id")
-    approver_id: int = Field(foreign_key="user.id")
+    expense_id: int = Field(foreign_key="expense.id", index=True)
+    approver_id: int = Field(foreign_key="user.id", index=True)
 
     expense: Optional[Expense] = Relationship(back_populates="approvals")
     approver: Optional[User] = Relationship(back_populates="approvals")
@@ -75,7 +121,7 @@ class ApprovalRequest(SQLModel, table=True):
 
 class ApprovalRule(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    company_id: int = Field(foreign_key="company.id")
+    company_id: int = Field(foreign_key="company.id", index=True)
     step: int
     approver_id: Optional[int] = Field(default=None, foreign_key="user.id")
     percentage_required: Optional[float] = None  # if set, requires % approvals
@@ -83,30 +129,126 @@ class ApprovalRule(SQLModel, table=True):
 
 
 # -----------------------
-# Auth (demo only, tokens)
+# Auth (signed JWTs)
 # -----------------------
+load_dotenv()
+SECRET_KEY = os.getenv("SECRET_KEY")
+if not SECRET_KEY:
+    # never fall back to a known key: anyone could forge tokens for any user
+    SECRET_KEY = secrets.token_urlsafe(32)
+    warnings.warn("SECRET_KEY is not set; using a random per-process key. Tokens will not survive "
+                  "a restart or be accepted by other workers.")
+ALGORITHM = "HS256"
+TOKEN_EXPIRE = timedelta(hours=1)  # no server-side logout: clients discard tokens, which expire on their own
+
 security = HTTPBearer()
-fake_tokens = {}  # token -> user_id
+_user_cache = TTLCache(maxsize=10000, ttl=30)  # user id -> detached User
+_password_cache = TTLCache(maxsize=5000, ttl=300)  # credential hash -> bcrypt verdict
+
+
+def _bcrypt_verify(password: str, hashed: str) -> bool:
+    try:
+        return bcrypt.verify(password, hashed)
+    except ValueError:  # stored value is not a bcrypt hash
+        return False
+
+
+async def hash_password(password: str) -> str:
+    return await anyio.to_thread.run_sync(bcrypt.hash, password)  # bcrypt is CPU-bound
+
+
+async def verify_password(email: str, password: str, hashed: str) -> bool:
+    # the stored hash is part of the key, so a password change never hits a stale verdict.
+    # TTLCache is not thread-safe: only the KDF runs in a worker thread, the cache stays on the event loop
+    key = hashlib.sha256(f"{email}:{password}:{hashed}".encode()).hexdigest()
+    verdict = _password_cache.get(key)
+    if verdict is None:
+        verdict = await anyio.to_thread.run_sync(_bcrypt_verify, password, hashed)
+        _password_cache[key] = verdict
+    return verdict
 
 
 def create_token(user_id: int) -> str:
-    token = str(uuid.uuid4())
-    fake_tokens[token] = user_id
-    return token
+    payload = {"sub": str(user_id), "exp": datetime.now(timezone.utc) + TOKEN_EXPIRE}
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def get_current_user(
+async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
 ) -> User:
-    token = credentials.credentials
-    if token not in fake_tokens:
+    # always verify: HMAC is cheap and this is what enforces exp, only the DB lookup is cached
+    try:
+        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
+        user_id = int(payload["sub"])
+    except (JWTError, KeyError, ValueError):
         raise HTTPException(status_code=401, detail="Invalid token")
-    user_id = fake_tokens[token]
-    user = session.get(User, user_id)
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    return user
+    user = _user_cache.get(user_id)
+    if user is None:
+        user = await session.get(User, user_id)
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
+        # keep a detached copy so later commits in this session don't expire the cached one
+        session.expunge(user)
+        _user_cache[user_id] = user
+    return await session.merge(user, load=False)
+
+
+async def get_company_admin(current_user: User = Depends(get_current_user)) -> User:
+    # a dependency, so the role check runs before any response cache lookup
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Only admin can view company expenses")
+    return current_user
+
+
+# -----------------------
+# Response cache
+# -----------------------
+def _approver_key(func, namespace: str = "", *, request=None, response=None, args=(), kwargs=None) -> str:
+    return f"{namespace}:{kwargs['current_user'].id}"
+
+
+def _company_key(func, namespace: str = "", *, request=None, response=None, args=(), kwargs=None) -> str:
+    return f"{namespace}:{kwargs['current_user'].company_id}"
+
+
+async def invalidate_cache(*namespaces: str) -> None:
+    # InMemoryBackend is per process: with several workers, the others keep serving their copy until
+    # it expires (15s). Switch FastAPICache.init to a shared backend such as Redis if that matters.
+    for namespace in namespaces:
+        await FastAPICache.clear(namespace)
+
+
+# -----------------------
+# Batch loaders
+# -----------------------
+async def load_expenses(session: AsyncSession, expense_ids: Iterable[int]) -> Dict[int, Expense]:
+    # one IN (...) query for the whole batch instead of a lazy load per row
+    ids = set(expense_ids)
+    if not ids:
+        return {}
+    result = await session.exec(select(Expense).where(Expense.id.in_(ids)).options(raiseload("*")))
+    return {expense.id: expense for expense in result.all()}
+
+
+# -----------------------
+# Approval rules cache
+# -----------------------
+RuleRow = Tuple[int, Optional[int], Optional[float], bool]  # step, approver_id, percentage_required, hybrid
+# filled on demand; rules are only edited outside the app, so entries simply expire
+_rules_cache = TTLCache(maxsize=1000, ttl=60)  # company id -> List[RuleRow]
+
+
+async def get_rules(session: AsyncSession, company_id: int) -> List[RuleRow]:
+    rules = _rules_cache.get(company_id)
+    if rules is None:
+        result = await session.exec(
+            select(ApprovalRule.step, ApprovalRule.approver_id,
+                   ApprovalRule.percentage_required, ApprovalRule.hybrid)
+            .where(ApprovalRule.company_id == company_id)
+        )
+        rules = _rules_cache[company_id] = [tuple(rule) for rule in result.all()]
+    return rules
 
 
 # -----------------------
@@ -116,108 +258,166 @@ app = FastAPI()
 
 
 @app.on_event("startup")
-def on_startup():
-    SQLModel.metadata.create_all(engine)
+async def on_startup():
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    FastAPICache.init(InMemoryBackend())
 
 
 # -----------------------
 # Routes
 # -----------------------
-@app.post("/signup")
-def signup(company: str, country: str, email: str, password: str, session: Session = Depends(get_session)):
-    # Demo: currency from country
-    currency_map = {"US": "USD", "IN": "INR", "UK": "GBP"}
-    currency = currency_map.get(country.upper(), "USD")
-
-    new_company = Company(name=company, country=country, currency=currency)
-    session.add(new_company)
-    session.commit()
-    session.refresh(new_company)
+_CURRENCY_MAP = MappingProxyType({"US": "USD", "IN": "INR", "UK": "GBP"})  # demo: currency from country
+_approver_cache = TTLCache(maxsize=10000, ttl=60)  # approval id -> approver id (never changes)
 
-    admin = User(email=email, password=password, role=UserRole.ADMIN, company_id=new_company.id)
-    session.add(admin)
-    session.commit()
-    session.refresh(admin)
 
-    token = create_token(admin.id)
-    return {"company": new_company.name, "admin_id": admin.id, "token": token}
+@app.post("/signup")
+async def signup(company: str, country: str, email: str, password: str,
+                 session: AsyncSession = Depends(get_session)):
+    currency = _CURRENCY_MAP.get(country.upper(), "USD")
+
+    hashed = await hash_password(password)
+
+    # INSERT ... RETURNING hands back the new ids without a refresh SELECT
+    result = await session.exec(
+        insert(Company).values(name=company, country=country, currency=currency).returning(Company.id)
+    )
+    company_id = result.scalar_one()
+    try:
+        result = await session.exec(
+            insert(User)
+            .values(email=email, password=hashed, role=UserRole.ADMIN, company_id=company_id)
+            .returning(User.id)
+        )
+    except IntegrityError:
+        await session.rollback()  # also drops the company row
+        raise HTTPException(status_code=409, detail="Email already registered")
+    admin_id = result.scalar_one()
+    await session.commit()
+
+    token = create_token(admin_id)
+    return {"company": company, "admin_id": admin_id, "token": token}
 
 
 @app.post("/login")
-def login(email: str, password: str, session: Session = Depends(get_session)):
-    user = session.exec(select(User).where(User.email == email, User.password == password)).first()
-    if not user:
+async def login(email: str, password: str, session: AsyncSession = Depends(get_session)):
+    result = await session.exec(select(User.id, User.password, User.role).where(User.email == email))
+    row = result.first()
+    if row and not bcrypt.identify(row.password):
+        # plaintext row from before hashing: check it once and upgrade it to a bcrypt hash
+        if not hmac.compare_digest(row.password.encode(), password.encode()):
+            raise HTTPException(status_code=400, detail="Invalid credentials")
+        hashed = await hash_password(password)
+        await session.exec(update(User).where(User.id == row.id).values(password=hashed))
+        await session.commit()
+    elif not row or not await verify_password(email, password, row.password):
         raise HTTPException(status_code=400, detail="Invalid credentials")
-    token = create_token(user.id)
-    return {"user_id": user.id, "role": user.role, "token": token}
+    token = create_token(row.id)
+    return {"user_id": row.id, "role": row.role, "token": token}
 
 
 @app.post("/users")
-def create_user(email: str, password: str, role: str, manager_id: Optional[int] = None,
-                current_user: User = Depends(get_current_user),
-                session: Session = Depends(get_session)):
+async def create_user(email: str, password: str, role: UserRole, manager_id: Optional[int] = None,
+                      current_user: User = Depends(get_current_user),
+                      session: AsyncSession = Depends(get_session)):
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(status_code=403, detail="Only admin can create users")
 
-    new_user = User(email=email, password=password, role=role, company_id=current_user.company_id,
+    hashed = await hash_password(password)
+    try:
+        result = await session.exec(
+            insert(User)
+            .values(email=email, password=hashed, role=role, company_id=current_user.company_id,
                     manager_id=manager_id)
-    session.add(new_user)
-    session.commit()
-    session.refresh(new_user)
-    return {"id": new_user.id, "email": new_user.email, "role": new_user.role}
+            .returning(User.id)
+        )
+    except IntegrityError as exc:
+        await session.rollback()
+        if "user.email" in str(exc.orig):
+            raise HTTPException(status_code=409, detail="Email already registered")
+        raise HTTPException(status_code=400, detail="Invalid manager_id")
+    user_id = result.scalar_one()
+    await session.commit()
+    return {"id": user_id, "email": email, "role": role}
 
 
 @app.post("/expenses")
-def submit_expense(amount: float, currency: str, category: str, description: str,
-                   current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    expense = Expense(amount=amount, currency=currency, category=category, description=description,
-                      date=datetime.utcnow(), user_id=current_user.id)
-    session.add(expense)
-    session.commit()
-    session.refresh(expense)
+async def submit_expense(amount: float, currency: str, category: str, description: str,
+                         current_user: User = Depends(get_current_user),
+                         session: AsyncSession = Depends(get_session)):
+    result = await session.exec(
+        insert(Expense)
+        .values(amount=amount, currency=currency, category=category, description=description,
+                user_id=current_user.id)
+        .returning(Expense.id)
+    )
+    expense_id = result.scalar_one()
 
     # Create approval requests per company rules
-    rules = session.exec(select(ApprovalRule).where(ApprovalRule.company_id == current_user.company_id)).all()
+    rules = await get_rules(session, current_user.company_id)
     if not rules and current_user.manager_id:  # fallback: manager approval
-        ar = ApprovalRequest(step=1, expense_id=expense.id, approver_id=current_user.manager_id)
-        session.add(ar)
+        ars = [ApprovalRequest(step=1, expense_id=expense_id, approver_id=current_user.manager_id)]
     else:
-        for rule in rules:
-            if rule.approver_id:
-                ar = ApprovalRequest(step=rule.step, expense_id=expense.id, approver_id=rule.approver_id)
-                session.add(ar)
+        ars = [ApprovalRequest(step=step, expense_id=expense_id, approver_id=approver_id)
+               for step, approver_id, _, _ in rules if approver_id]
+    session.add_all(ars)
 
-    session.commit()
-    return {"expense_id": expense.id, "status": "submitted"}
+    await session.commit()
+    await invalidate_cache("approvals", "company_expenses")
+    return {"expense_id": expense_id, "status": "submitted"}
 
 
 @app.get("/approvals")
-def get_approvals(current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    approvals = session.exec(select(ApprovalRequest).where(ApprovalRequest.approver_id == current_user.id)).all()
+@cache(expire=15, namespace="approvals", key_builder=_approver_key)
+async def get_approvals(current_user: User = Depends(get_current_user),
+                        session: AsyncSession = Depends(get_session)):
+    result = await session.exec(
+        select(ApprovalRequest.id, ApprovalRequest.status, ApprovalRequest.step,
+               ApprovalRequest.expense_id, ApprovalRequest.approver_id)
+        .where(ApprovalRequest.approver_id == current_user.id)
+    )
+    approvals = [row._asdict() for row in result.all()]
+    _approver_cache.update((a["id"], a["approver_id"]) for a in approvals)
+    expenses = await load_expenses(session, (a["expense_id"] for a in approvals))
+    for approval in approvals:
+        approval["expense"] = expenses.get(approval["expense_id"])
     return approvals
 
 
 @app.post("/approvals/{approval_id}")
-def act_on_approval(approval_id: int, action: str,
-                    current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    approval = session.get(ApprovalRequest, approval_id)
-    if not approval or approval.approver_id != current_user.id:
+async def act_on_approval(approval_id: int, action: str,
+                          current_user: User = Depends(get_current_user),
+                          session: AsyncSession = Depends(get_session)):
+    cached_approver = _approver_cache.get(approval_id)
+    if cached_approver is not None and cached_approver != current_user.id:
         raise HTTPException(status_code=404, detail="Approval not found")
 
     if action not in ["approved", "rejected"]:
         raise HTTPException(status_code=400, detail="Invalid action")
 
-    approval.status = action
-    session.add(approval)
-    session.commit()
-    return {"approval_id": approval.id, "status": approval.status}
+    # the approver check is part of the WHERE clause, so auth and write are one statement
+    result = await session.exec(
+        update(ApprovalRequest)
+        .where(ApprovalRequest.id == approval_id, ApprovalRequest.approver_id == current_user.id)
+        .values(status=action)
+    )
+    if result.rowcount == 0:
+        raise HTTPException(status_code=404, detail="Approval not found")
+    await session.commit()
+    _approver_cache[approval_id] = current_user.id
+    await invalidate_cache("approvals")
+    return {"approval_id": approval_id, "status": action}
 
 
 @app.get("/company/expenses")
-def list_company_expenses(current_user: User = Depends(get_current_user), session: Session = Depends(get_session)):
-    if current_user.role != UserRole.ADMIN:
-        raise HTTPException(status_code=403, detail="Only admin can view company expenses")
-    expenses = session.exec(select(Expense).where(Expense.user_id.in_(
-        [u.id for u in current_user.company.users]
-    ))).all()
-    return expenses
+@cache(expire=15, namespace="company_expenses", key_builder=_company_key)
+async def list_company_expenses(current_user: User = Depends(get_company_admin),
+                                session: AsyncSession = Depends(get_session)):
+    stmt = (
+        select(Expense)
+        .join(User, Expense.user_id == User.id)
+        .where(User.company_id == current_user.company_id)
+        .options(raiseload("*"))  # lazy relationship loads fail loudly instead of going N+1
+    )
+    result = await session.exec(stmt)
+    return result.all()